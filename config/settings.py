@@ -15,10 +15,41 @@ EXCEL_HEADERS = [
     "Mailing Address", "Terms", "Bill Date", "Due Date", "Category", "Description", "Amount", "Memo", "Total"
 ]
 
+DB_UPDATE_HEADERS = [
+    "Line_Item_ID", "Order_ID", "CPT", "BR_Paid", "BR_Rate", "EOBR_Doc_No", "Date_Processed"
+]
+
+# Leftover update logs older than this are assumed to come from a crashed run
+DB_UPDATES_RECOVERY_AGE_SECONDS = 3600
+
+# EOBR rows are written to the workbooks in chunks of this size
+EXCEL_FLUSH_ROWS = 10
+
 # Acceptable values
 ACCEPTABLE_MODIFIERS = {"26", "25", "TC", "RT", "LT", "59"}
 ACCEPTABLE_POS = {"49", "11"}
 
 # Business rules
 DEFAULT_TERMS = "Net 45"
-DEFAULT_CATEGORY = "Subcontracted Services:Provider Services"
\ No newline at end of file
+DEFAULT_CATEGORY = "Subcontracted Services:Provider Services"
+
+# Multi-worker coordination
+CLAIMS_TABLE = "processing_claims"
+CLAIM_LEASE_SECONDS = 300
+LOCK_TIMEOUT_SECONDS = 600
+DB_BUSY_TIMEOUT_SECONDS = 30
+
+# EOBR serial allocation
+SERIALS_TABLE = "eobr_serials"
+
+# Watch mode
+WATCH_POLL_INTERVAL_SECONDS = 0.1
+WATCH_BATCH_SIZE = 50
+WATCH_MAX_RETRIES = 5
+WATCH_RETRY_MAX_SECONDS = 60
+
+# Render cache
+RENDER_CACHE_DIR = os.path.join(BASE_PATH, "render_cache")
+RENDER_CACHE_MAX_BYTES = 500 * 1024 * 1024
+RENDER_CACHE_MAX_AGE_DAYS = 30
+RENDER_CACHE_EVICT_INTERVAL_SECONDS = 600
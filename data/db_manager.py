@@ -1,7 +1,12 @@
 import sqlite3
 import os
+import time
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from config.settings import DB_PATH
+from config.settings import (
+    DB_PATH, CLAIMS_TABLE, CLAIM_LEASE_SECONDS, LOCK_TIMEOUT_SECONDS, DB_BUSY_TIMEOUT_SECONDS
+)
 
 def initialize_database():
     """Initialize SQLite database connection"""
@@ -27,6 +32,17 @@ def initialize_database():
         print(f"Error connecting to database: {e}")
         return False
 
+_connection = None
+
+def get_connection():
+    """Return a shared database connection, validating the database on first use"""
+    global _connection
+    if _connection is None:
+        if not initialize_database():
+            return None
+        _connection = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_SECONDS)
+    return _connection
+
 def check_if_item_paid(line_item_id, order_id):
     """
     Check if a line item has already been paid
@@ -41,10 +57,10 @@ def check_if_item_paid(line_item_id, order_id):
     if not line_item_id or not order_id:
         return False
     
-    if not initialize_database():
+    conn = get_connection()
+    if conn is None:
         return False
     
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     # Check if the line item exists and has been paid
@@ -54,7 +70,6 @@ def check_if_item_paid(line_item_id, order_id):
     )
     
     result = cursor.fetchone()
-    conn.close()
     
     return result is not None
 
@@ -77,10 +92,10 @@ def update_payment_info(line_item_id, order_id, br_paid, br_rate, eobr_doc_no, h
     if not line_item_id or not order_id:
         return False
     
-    if not initialize_database():
+    conn = get_connection()
+    if conn is None:
         return False
     
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
@@ -106,15 +121,13 @@ def update_payment_info(line_item_id, order_id, br_paid, br_rate, eobr_doc_no, h
         print(f"Error updating payment info: {e}")
         conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def list_line_items(order_id=None):
     """List line items in the database, optionally filtered by order_id"""
-    if not initialize_database():
+    conn = get_connection()
+    if conn is None:
         return
     
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
@@ -131,5 +144,191 @@ def list_line_items(order_id=None):
             
     except Exception as e:
         print(f"Error listing line items: {e}")
+
+_transaction_connections = threading.local()
+
+def get_transaction_connection():
+    """
+    Return this thread's connection that manages its own transactions (for BEGIN IMMEDIATE)
+    
+    The connection is opened once per thread and reused, like get_connection.
+    """
+    conn = getattr(_transaction_connections, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_SECONDS, isolation_level=None)
+        _transaction_connections.conn = conn
+    return conn
+
+def initialize_claims_table():
+    """Create the claim/lease table used to coordinate multiple workers"""
+    if not initialize_database():
+        return False
+    
+    conn = get_transaction_connection()
+    try:
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {CLAIMS_TABLE} (
+            claim_key TEXT PRIMARY KEY,
+            worker_id TEXT NOT NULL,
+            claimed_at REAL NOT NULL,
+            lease_expires_at REAL NOT NULL
+        )
+        ''')
+        return True
+    except Exception as e:
+        print(f"Error creating claims table: {e}")
+        return False
+
+def claim_order(order_id, worker_id, lease_seconds=CLAIM_LEASE_SECONDS):
+    """
+    Atomically claim an order for processing by this worker
+    
+    A claim held by another worker blocks this one until its lease expires,
+    so orders left behind by a crashed worker are picked up again later.
+    
+    Args:
+        order_id (str): The order ID to claim
+        worker_id (str): Identifier of the claiming worker
+        lease_seconds (int): How long the claim is valid
+        
+    Returns:
+        bool: True if this worker now holds the claim, False otherwise
+    """
+    if not order_id:
+        return False
+    
+    now = time.time()
+    conn = get_transaction_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(f'''
+        INSERT INTO {CLAIMS_TABLE} (claim_key, worker_id, claimed_at, lease_expires_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(claim_key) DO UPDATE SET
+            worker_id = excluded.worker_id,
+            claimed_at = excluded.claimed_at,
+            lease_expires_at = excluded.lease_expires_at
+        WHERE {CLAIMS_TABLE}.lease_expires_at < ? OR {CLAIMS_TABLE}.worker_id = ?
+        ''', (str(order_id), worker_id, now, now + lease_seconds, now, worker_id))
+        claimed = cursor.rowcount > 0
+        conn.execute("COMMIT")
+        return claimed
+    except Exception as e:
+        print(f"Error claiming order {order_id}: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        return False
+
+def release_claim(order_id, worker_id):
+    """Release a claim held by this worker"""
+    if not order_id:
+        return
+    
+    conn = get_transaction_connection()
+    try:
+        conn.execute(
+            f'DELETE FROM {CLAIMS_TABLE} WHERE claim_key = ? AND worker_id = ?',
+            (str(order_id), worker_id)
+        )
+    except Exception as e:
+        print(f"Error releasing claim on order {order_id}: {e}")
+
+def acquire_lock(lock_name, worker_id, lease_seconds=CLAIM_LEASE_SECONDS,
+                 timeout_seconds=LOCK_TIMEOUT_SECONDS, poll_seconds=0.2):
+    """
+    Block until this worker holds the named lock in the claims table
+    
+    Raises:
+        TimeoutError: If the lock could not be taken within timeout_seconds
+    """
+    claim_key = f"lock:{lock_name}"
+    deadline = time.time() + timeout_seconds
+    while not claim_order(claim_key, worker_id, lease_seconds):
+        if time.time() >= deadline:
+            raise TimeoutError(f"Timed out after {timeout_seconds}s waiting for lock {lock_name}")
+        time.sleep(poll_seconds)
+
+def release_lock(lock_name, worker_id):
+    """Release a lock taken with acquire_lock"""
+    release_claim(f"lock:{lock_name}", worker_id)
+
+@contextmanager
+def hold_lock(lock_name, worker_id, lease_seconds=CLAIM_LEASE_SECONDS):
+    """
+    Hold the named lock for the duration of a with block
+    
+    The lease is renewed in the background so long operations keep the lock.
+    """
+    acquire_lock(lock_name, worker_id, lease_seconds)
+    stop = threading.Event()
+    
+    def renew():
+        while not stop.wait(lease_seconds / 3):
+            if not claim_order(f"lock:{lock_name}", worker_id, lease_seconds):
+                print(f"Warning: Could not renew lock {lock_name}")
+    
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
     finally:
-        conn.close() 
\ No newline at end of file
+        stop.set()
+        renewer.join()
+        release_lock(lock_name, worker_id)
+
+def pay_line_items(order_id, line_payments, eobr_doc_no, hcfa_doc_no, br_date_processed):
+    """
+    Record payment for all line items of an order in a single transaction
+    
+    Each line is only updated while BR_paid is still NULL. If any line turns
+    out to be paid already, the whole transaction is rolled back so an order
+    is never paid twice.
+    
+    Args:
+        order_id (str): The order ID
+        line_payments (list): (line_item_id, br_paid, br_rate) tuples
+        eobr_doc_no (str): The EOBR document number
+        hcfa_doc_no (str): The HCFA document number
+        br_date_processed (str): The date the payment was processed
+        
+    Returns:
+        list: IDs of the line items that were updated, or None if rolled back
+    """
+    if not order_id or not line_payments:
+        return []
+    
+    conn = get_transaction_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        updated_ids = []
+        for line_item_id, br_paid, br_rate in line_payments:
+            cursor = conn.execute('''
+            UPDATE line_items SET 
+                BR_paid = ?,
+                BR_rate = ?,
+                EOBR_doc_no = ?,
+                HCFA_doc_no = ?,
+                BR_date_processed = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND Order_ID = ? AND BR_paid IS NULL
+            ''', (br_paid, br_rate, eobr_doc_no, hcfa_doc_no, br_date_processed, line_item_id, order_id))
+            
+            if cursor.rowcount > 0:
+                updated_ids.append(line_item_id)
+            elif conn.execute(
+                'SELECT 1 FROM line_items WHERE id = ? AND Order_ID = ? AND BR_paid IS NOT NULL',
+                (line_item_id, order_id)
+            ).fetchone():
+                print(f"Line item {line_item_id}, order {order_id} was paid by another worker; rolling back")
+                conn.execute("ROLLBACK")
+                return None
+        
+        conn.execute("COMMIT")
+        print(f"Updated payment info for order {order_id}: {len(updated_ids)} line item(s)")
+        return updated_ids
+        
+    except Exception as e:
+        print(f"Error updating payment info: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        return None
@@ -1,7 +1,12 @@
 import os
+import glob
+import json
+import time
 from pathlib import Path
 from openpyxl import Workbook, load_workbook
-from config.settings import EXCEL_HEADERS, HISTORICAL_EXCEL_PATH
+from config.settings import (
+    BASE_PATH, EXCEL_HEADERS, HISTORICAL_EXCEL_PATH, DB_UPDATE_HEADERS, DB_UPDATES_RECOVERY_AGE_SECONDS
+)
 
 def initialize_excel_file(file_path):
     """Initialize an Excel file with headers if it doesn't exist"""
@@ -12,60 +17,157 @@ def initialize_excel_file(file_path):
         ws.append(EXCEL_HEADERS)
         wb.save(file_path)
 
-def load_historical_duplicates():
-    """Load historical duplicates and control numbers from Excel"""
-    historical_duplicates = {}
-    max_control_numbers = {}
+def _iter_historical_rows():
+    """Yield (full duplicate key, EOBR number, description) for each historical row"""
+    if not Path(HISTORICAL_EXCEL_PATH).exists():
+        return
     
-    if Path(HISTORICAL_EXCEL_PATH).exists():
-        wb = load_workbook(HISTORICAL_EXCEL_PATH, read_only=True)
+    wb = load_workbook(HISTORICAL_EXCEL_PATH, read_only=True)
+    try:
         ws = wb.active
-        rows = list(ws.rows)[1:]  # Skip header
-        
-        for row in rows:
+        for row in ws.iter_rows(min_row=2):  # Skip header
             full_dup_key = row[2].value if len(row) > 2 else None
             eobr_number_value = row[4].value if len(row) > 4 else None
             description = row[11].value if len(row) > 11 else None
-            
-            if full_dup_key and '|' in full_dup_key:
-                historical_key = full_dup_key
+            yield full_dup_key, eobr_number_value, description
+    finally:
+        wb.close()
+
+def load_historical_duplicates():
+    """Load historical duplicate keys from Excel"""
+    historical_duplicates = {}
+    
+    for full_dup_key, eobr_number_value, description in _iter_historical_rows():
+        if full_dup_key and '|' in full_dup_key:
+            historical_key = full_dup_key
+        else:
+            control_number = None
+            if eobr_number_value and '-' in eobr_number_value:
+                control_number = eobr_number_value.split('-')[0]
+            if control_number and description:
+                cpt_part = description.split(',')[0].strip()
+                historical_key = f"{control_number}|{cpt_part}"
             else:
-                control_number = None
-                if eobr_number_value and '-' in eobr_number_value:
-                    control_number = eobr_number_value.split('-')[0]
-                if control_number and description:
-                    cpt_part = description.split(',')[0].strip()
-                    historical_key = f"{control_number}|{cpt_part}"
-                else:
-                    historical_key = full_dup_key or "Unknown"
-                    
-            if historical_key:
-                historical_duplicates[historical_key] = True
+                historical_key = full_dup_key or "Unknown"
                 
-            if eobr_number_value and '-' in eobr_number_value:
-                parts = eobr_number_value.split('-')
-                control_number = parts[0]
-                try:
-                    serial_number = int(parts[1])
-                except (ValueError, IndexError):
-                    serial_number = 0
-                if control_number:
-                    max_control_numbers[control_number] = max(
-                        max_control_numbers.get(control_number, 0),
-                        serial_number
-                    )
-        wb.close()
+        if historical_key:
+            historical_duplicates[historical_key] = True
+        
+    return historical_duplicates
+
+def load_historical_serials():
+    """Load the highest EOBR serial issued per control number from Excel"""
+    max_control_numbers = {}
+    
+    for full_dup_key, eobr_number_value, description in _iter_historical_rows():
+        if eobr_number_value and '-' in eobr_number_value:
+            parts = eobr_number_value.split('-')
+            control_number = parts[0]
+            try:
+                serial_number = int(parts[1])
+            except (ValueError, IndexError):
+                serial_number = 0
+            if control_number:
+                max_control_numbers[control_number] = max(
+                    max_control_numbers.get(control_number, 0),
+                    serial_number
+                )
         
-    return historical_duplicates, max_control_numbers
+    return max_control_numbers
 
 def append_to_excel(file_path, data):
     """Append data to Excel file"""
+    append_rows_to_excel(file_path, [data])
+
+def append_rows_to_excel(file_path, rows):
+    """Append several records to an Excel file with a single load and save"""
+    if not rows:
+        return
+    
     wb = load_workbook(file_path)
     ws = wb.active
-    ws.append([
-        data.get("Release Payment"), data.get("Duplicate Check"), data.get("Full Duplicate Key"),
-        data.get("Input File"), data.get("EOBR Number"), data.get("Vendor"), data.get("Mailing Address"),
-        data.get("Terms"), data.get("Bill Date"), data.get("Due Date"), data.get("Category"), data.get("Description"),
-        data.get("Amount"), data.get("Memo"), data.get("Total"),
-    ])
-    wb.save(file_path)
\ No newline at end of file
+    for data in rows:
+        ws.append([
+            data.get("Release Payment"), data.get("Duplicate Check"), data.get("Full Duplicate Key"),
+            data.get("Input File"), data.get("EOBR Number"), data.get("Vendor"), data.get("Mailing Address"),
+            data.get("Terms"), data.get("Bill Date"), data.get("Due Date"), data.get("Category"), data.get("Description"),
+            data.get("Amount"), data.get("Memo"), data.get("Total"),
+        ])
+    wb.save(file_path)
+
+def append_db_updates(log_path, updates):
+    """Append database updates to a JSON Lines log, one object per line"""
+    if not updates:
+        return
+    
+    with open(log_path, "a", encoding="utf-8") as f:
+        for update in updates:
+            f.write(json.dumps({header: update.get(header) for header in DB_UPDATE_HEADERS}) + "\n")
+
+def finalize_db_updates(log_path, excel_path):
+    """
+    Convert a database update log into an Excel report
+    
+    Rows are streamed into a write-only workbook so memory stays flat however
+    long the log is. If the report already exists (a recovered earlier part of
+    the same run), the rows are appended to it instead. The log is removed
+    once the report has been saved.
+    
+    Returns:
+        int: Number of rows written
+    """
+    if not Path(log_path).exists():
+        return 0
+    
+    if Path(excel_path).exists():
+        wb = load_workbook(excel_path)
+        ws = wb.active
+    else:
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Sheet1")  # Same sheet name pandas used
+        ws.append(DB_UPDATE_HEADERS)
+    
+    row_count = 0
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            ws.append([update.get(header) for header in DB_UPDATE_HEADERS])
+            row_count += 1
+    
+    wb.save(excel_path)
+    os.remove(log_path)
+    return row_count
+
+def recover_db_update_logs(base_path=BASE_PATH, min_age_seconds=DB_UPDATES_RECOVERY_AGE_SECONDS):
+    """
+    Finalize Database_Updates logs left behind by runs that crashed
+    
+    Logs written to within min_age_seconds may belong to a run that is still
+    going and are left alone. A log is renamed before it is converted, so a
+    live run that appends later starts a new log instead of losing rows.
+    
+    Returns:
+        list: Paths of the Excel reports that were written
+    """
+    excel_glob = os.path.join(base_path, "*", "excel")
+    for log_path in glob.glob(os.path.join(excel_glob, "Database_Updates_*.jsonl")):
+        try:
+            if time.time() - os.path.getmtime(log_path) < min_age_seconds:
+                continue
+            os.replace(log_path, f"{log_path}.recovering")
+        except OSError:
+            continue  # Finished, or in use by another process
+    
+    recovered = []
+    for recovering_path in glob.glob(os.path.join(excel_glob, "Database_Updates_*.jsonl.recovering")):
+        excel_path = recovering_path[:-len(".jsonl.recovering")] + ".xlsx"
+        try:
+            rows = finalize_db_updates(recovering_path, excel_path)
+        except Exception as e:
+            print(f"Error recovering database updates from {recovering_path}: {e}")
+            continue
+        print(f"Recovered {rows} database updates from an interrupted run into: {excel_path}")
+        recovered.append(excel_path)
+    return recovered
@@ -0,0 +1,93 @@
+from config.settings import SERIALS_TABLE
+from data.db_manager import initialize_database, get_transaction_connection
+
+def initialize_serial_table():
+    """Create the control number -> last serial counter table if needed"""
+    if not initialize_database():
+        return False
+
+    conn = get_transaction_connection()
+    try:
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {SERIALS_TABLE} (
+            control_number TEXT PRIMARY KEY,
+            last_serial INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        return True
+    except Exception as e:
+        print(f"Error creating serial table: {e}")
+        return False
+
+def serial_table_is_empty():
+    """Return True if no serials have been recorded yet"""
+    conn = get_transaction_connection()
+    return conn.execute(f'SELECT 1 FROM {SERIALS_TABLE} LIMIT 1').fetchone() is None
+
+def seed_serials(max_serials):
+    """
+    Seed the counter table from previously issued serials
+
+    Existing counters are only ever raised, never lowered.
+
+    Args:
+        max_serials (dict): control number -> highest serial already issued
+    """
+    if not max_serials:
+        return
+
+    conn = get_transaction_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(f'''
+        INSERT INTO {SERIALS_TABLE} (control_number, last_serial) VALUES (?, ?)
+        ON CONFLICT(control_number) DO UPDATE SET
+            last_serial = MAX(last_serial, excluded.last_serial)
+        ''', [(str(control_number), serial) for control_number, serial in max_serials.items()])
+        conn.execute("COMMIT")
+        print(f"Seeded EOBR serials for {len(max_serials)} control numbers")
+    except Exception as e:
+        print(f"Error seeding EOBR serials: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+def reserve_serials(counts):
+    """
+    Reserve consecutive serials for several control numbers in one transaction
+
+    Args:
+        counts (dict): control number -> number of serials needed
+
+    Returns:
+        dict: control number -> list of reserved serials, in ascending order
+    """
+    reserved = {}
+    if not counts:
+        return reserved
+
+    conn = get_transaction_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for control_number, count in counts.items():
+            control_number = str(control_number)
+            conn.execute(f'''
+            INSERT INTO {SERIALS_TABLE} (control_number, last_serial) VALUES (?, ?)
+            ON CONFLICT(control_number) DO UPDATE SET
+                last_serial = last_serial + excluded.last_serial
+            ''', (control_number, count))
+            last_serial = conn.execute(
+                f'SELECT last_serial FROM {SERIALS_TABLE} WHERE control_number = ?',
+                (control_number,)
+            ).fetchone()[0]
+            reserved[control_number] = list(range(last_serial - count + 1, last_serial + 1))
+        conn.execute("COMMIT")
+        return reserved
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+def allocate_serial(control_number):
+    """Atomically allocate the next serial for a control number"""
+    return reserve_serials({control_number: 1})[str(control_number)][0]
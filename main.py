@@ -1,23 +1,49 @@
 import os
 import json
 import glob
+import shutil
+import time
+import zlib
+import socket
+import argparse
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
-import pandas as pd
 
 # Import from modules
-from config.settings import BASE_PATH, JSON_DIR_PATH, HISTORICAL_EXCEL_PATH
+from config.settings import (
+    BASE_PATH, JSON_DIR_PATH, HISTORICAL_EXCEL_PATH, EXCEL_FLUSH_ROWS, RENDER_CACHE_EVICT_INTERVAL_SECONDS,
+    WATCH_POLL_INTERVAL_SECONDS, WATCH_BATCH_SIZE, WATCH_MAX_RETRIES, WATCH_RETRY_MAX_SECONDS
+)
 from utils.validators import validate_record
-from data.excel_manager import initialize_excel_file, load_historical_duplicates, append_to_excel
+from utils.file_watcher import snapshot_directory, find_ready_files
+from data.excel_manager import (
+    initialize_excel_file, load_historical_duplicates, load_historical_serials, append_rows_to_excel,
+    append_db_updates, finalize_db_updates, recover_db_update_logs
+)
+from data.serial_manager import initialize_serial_table, serial_table_is_empty, seed_serials, allocate_serial
 from processors.document_processor import generate_document
+from processors.render_cache import evict_render_cache, get_cache_stats, reset_cache_stats
 from processors.eobr_processor import collect_additional_eobr_data
-from data.db_manager import check_if_item_paid, update_payment_info, list_line_items
+from data.db_manager import (
+    check_if_item_paid, list_line_items,
+    initialize_claims_table, claim_order, release_claim, pay_line_items,
+    hold_lock
+)
 
 def setup_folder_structure():
     """Create folder structure for current run"""
     current_date = datetime.now().strftime("%Y%m%d_%H%M%S")
     run_folder = os.path.join(BASE_PATH, current_date)
     
+    # Watch mode can start several batches within the same second
+    suffix = 1
+    while Path(run_folder).exists():
+        suffix += 1
+        run_folder = os.path.join(BASE_PATH, f"{current_date}_{suffix}")
+    if suffix > 1:
+        current_date = f"{current_date}_{suffix}"
+    
     folder_structure = {
         'root': run_folder,
         'docs': os.path.join(run_folder, 'docs'),
@@ -30,6 +56,7 @@ def setup_folder_structure():
         
     folder_structure['current_excel'] = os.path.join(folder_structure['excel'], f"EOBR_Data_{current_date}.xlsx")
     folder_structure['db_updates_excel'] = os.path.join(folder_structure['excel'], f"Database_Updates_{current_date}.xlsx")
+    folder_structure['db_updates_log'] = os.path.join(folder_structure['excel'], f"Database_Updates_{current_date}.jsonl")
     return folder_structure
 
 def adapt_record_format(record, filename):
@@ -64,29 +91,39 @@ def adapt_record_format(record, filename):
     
     return adapted_record
 
-def process_json_directory(json_dir_path):
-    """Process all JSON files in a directory and generate EOBR reports"""
-    # Setup
-    folders = setup_folder_structure()
-    initialize_excel_file(folders['current_excel'])
-    initialize_excel_file(HISTORICAL_EXCEL_PATH)
-    historical_duplicates, processed_control_numbers = load_historical_duplicates()
-    
-    # Get all JSON files in the directory
-    json_files = glob.glob(os.path.join(json_dir_path, "*.json"))
-    print(f"Found {len(json_files)} JSON files to process.")
+def worker_owns_control_number(control_number, worker_index, worker_count):
+    """Return True if a control number falls in this worker's partition"""
+    if worker_count <= 1:
+        return True
+    return zlib.crc32(str(control_number).encode("utf-8")) % worker_count == worker_index
+
+def find_paid_line_item(record):
+    """Return the ID of the first line item that has already been paid, if any"""
+    order_id = record.get("Order_ID")
+    for line in record.get("service_lines", []):
+        payment_id = line.get("payment_id", {})
+        line_item_id = payment_id.get("line_item_id")
+        
+        if check_if_item_paid(line_item_id, order_id):
+            return line_item_id
+    return None
+
+def select_records(json_files, worker_index=0, worker_count=1):
+    """
+    Load the JSON files and keep the records this worker should process
     
-    processed_count = 0
+    Returns:
+        tuple: (list of (file path, record, adapted_record), skipped count,
+                paths of files that failed with errors)
+    """
+    selected = []
     skipped_count = 0
-    processed_order_ids = set()  # Track processed order IDs
-    
-    # Track database updates
-    db_updates = []
+    failed_paths = []
     
     for json_file_path in json_files:
         filename = os.path.basename(json_file_path)
         try:
-            # Load and process JSON data
+            # Load JSON data
             with open(json_file_path, "r") as f:
                 record = json.load(f)
             
@@ -96,21 +133,14 @@ def process_json_directory(json_dir_path):
                 skipped_count += 1
                 continue
             
-            # Check if any service line has already been paid
-            order_id = record.get("Order_ID")
-            service_lines = record.get("service_lines", [])
-            already_paid = False
-            
-            for line in service_lines:
-                payment_id = line.get("payment_id", {})
-                line_item_id = payment_id.get("line_item_id")
-                
-                if check_if_item_paid(line_item_id, order_id):
-                    print(f"Skipping file {filename}: Line item {line_item_id} has already been paid.")
-                    already_paid = True
-                    break
+            control_number = record.get("order_details", {}).get("FileMaker_Record_Number")
+            if not worker_owns_control_number(control_number, worker_index, worker_count):
+                continue
             
-            if already_paid:
+            # Check if any service line has already been paid
+            paid_line_item_id = find_paid_line_item(record)
+            if paid_line_item_id is not None:
+                print(f"Skipping file {filename}: Line item {paid_line_item_id} has already been paid.")
                 skipped_count += 1
                 continue
             
@@ -123,85 +153,394 @@ def process_json_directory(json_dir_path):
                 skipped_count += 1
                 continue
             
-            # Process the record
-            eobr_data = collect_additional_eobr_data(
-                adapted_record, {}, historical_duplicates, processed_control_numbers
-            )
+            selected.append((json_file_path, record, adapted_record))
             
-            # Save to Excel
-            append_to_excel(folders['current_excel'], eobr_data)
-            append_to_excel(HISTORICAL_EXCEL_PATH, eobr_data)
+        except Exception as e:
+            print(f"Error processing file {filename}: {e}")
+            skipped_count += 1
+            failed_paths.append(json_file_path)
+    
+    return selected, skipped_count, failed_paths
+
+def process_record(record, adapted_record, filename, folders, historical_duplicates, next_serial, eobr_rows):
+    """
+    Process a single selected record: generate the EOBR and record the payment
+    
+    The record's Excel row is added to eobr_rows; the caller writes the rows
+    to the workbooks in chunks.
+    
+    Returns:
+        list: Database updates for the record, or None if it was skipped
+    """
+    # An earlier file in this run, or another worker, may have paid the order since it was selected
+    paid_line_item_id = find_paid_line_item(record)
+    if paid_line_item_id is not None:
+        print(f"Skipping file {filename}: Line item {paid_line_item_id} has already been paid.")
+        return None
+    
+    # Process the record; the serial is only allocated once the record will be paid
+    eobr_data = collect_additional_eobr_data(
+        adapted_record, {}, historical_duplicates, next_serial
+    )
+    
+    # Generate documents
+    try:
+        docx_path, pdf_path = generate_document(adapted_record, eobr_data, folders)
+    except Exception as e:
+        print(f"Error generating documents for {filename}: {e}")
+        # Drop any partially written document
+        discard_eobr(os.path.join(folders['docs'], f"EOBR_{eobr_data['EOBR Number']}.docx"), None)
+        return None
+    print(f"Generated EOBR {eobr_data['EOBR Number']}")
+    
+    # Update database with payment information and track updates
+    updated_items = update_database_with_payment(record, eobr_data)
+    if updated_items is None:
+        # Payment was rolled back, so this EOBR must not be paid out
+        discard_eobr(docx_path, pdf_path)
+        print(f"Discarded EOBR {eobr_data['EOBR Number']} for {filename}: payment was rolled back.")
+        return None
+    
+    # Record the duplicate key and queue for Excel only once the payment has committed
+    historical_duplicates[eobr_data["Full Duplicate Key"]] = True
+    eobr_rows.append(eobr_data)
+    return updated_items
+
+def discard_eobr(docx_path, pdf_path):
+    """Remove the documents of an EOBR that was not paid"""
+    for path in (docx_path, pdf_path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+@contextmanager
+def historical_workbook_lock(coordinated, worker_id):
+    """Serialize access to the shared historical workbook between workers"""
+    if not coordinated:
+        yield
+        return
+    with hold_lock("historical_workbook", worker_id):
+        yield
+
+def flush_eobr_rows(folders, eobr_rows, state):
+    """
+    Write queued EOBR rows to the run workbook, then the historical workbook
+    
+    Rows move to state['pending_history_rows'] once they are in the run
+    workbook, so a failed historical append never writes them to the run
+    workbook twice and is retried on the next flush.
+    """
+    if eobr_rows:
+        append_rows_to_excel(folders['current_excel'], eobr_rows)
+        state['pending_history_rows'].extend(eobr_rows)
+        eobr_rows.clear()
+    
+    history_rows = state['pending_history_rows']
+    if history_rows:
+        with historical_workbook_lock(state['coordinated'], state['worker_id']):
+            append_rows_to_excel(HISTORICAL_EXCEL_PATH, history_rows)
+        history_rows.clear()
+
+def try_flush_eobr_rows(folders, eobr_rows, state):
+    """Flush EOBR rows, keeping them queued for the next attempt if a workbook cannot be written"""
+    try:
+        flush_eobr_rows(folders, eobr_rows, state)
+    except Exception as e:
+        pending = [row["EOBR Number"] for row in eobr_rows + state['pending_history_rows']]
+        print(f"Error writing EOBR rows to Excel: {e}. Still pending: {', '.join(pending)}")
+
+def initialize_run_state(worker_index=0, worker_count=1, coordinated=False):
+    """
+    Validate the database and load everything that stays warm between batches
+    
+    With several workers, each one only handles the control numbers in its
+    partition and claims every order in the database before paying it.
+    
+    Returns:
+        dict: Run state shared by all batches, or None if setup failed
+    """
+    coordinated = coordinated or worker_count > 1
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    if coordinated:
+        if not initialize_claims_table():
+            print("Error: Could not initialize claims table, aborting coordinated run.")
+            return None
+        print(f"Worker {worker_id} handling partition {worker_index + 1} of {worker_count}")
+    
+    if not initialize_serial_table():
+        print("Error: Could not initialize EOBR serial table, aborting run.")
+        return None
+    
+    with historical_workbook_lock(coordinated, worker_id):
+        initialize_excel_file(HISTORICAL_EXCEL_PATH)
+        if serial_table_is_empty():
+            # One-time migration of serials issued before the counter table existed
+            seed_serials(load_historical_serials())
+        historical_duplicates = load_historical_duplicates()
+        recover_db_update_logs()
+    
+    return {
+        'worker_id': worker_id,
+        'worker_index': worker_index,
+        'worker_count': worker_count,
+        'coordinated': coordinated,
+        'historical_duplicates': historical_duplicates,
+        'pending_history_rows': [],
+        'last_cache_eviction': 0,
+    }
+
+def process_json_files(json_files, state, verify=True):
+    """
+    Process a batch of JSON files into a new run folder
+    
+    With verify, the database rows of every processed order are printed.
+    
+    Returns:
+        tuple: (paths of files that failed with errors,
+                paths of files skipped because another worker holds the order)
+    """
+    coordinated = state['coordinated']
+    worker_id = state['worker_id']
+    
+    reset_cache_stats()
+    selected, skipped_count, failed_paths = select_records(
+        json_files, state['worker_index'], state['worker_count']
+    )
+    claimed_paths = []
+    if not selected:
+        print(f"No files to process. Skipped: {skipped_count}")
+        return failed_paths, claimed_paths
+    
+    # Setup
+    folders = setup_folder_structure()
+    initialize_excel_file(folders['current_excel'])
+    
+    processed_count = 0
+    processed_order_ids = set()  # Track processed order IDs
+    eobr_rows = []
+    
+    try:
+        for json_file_path, record, adapted_record in selected:
+            filename = os.path.basename(json_file_path)
+            order_id = record.get("Order_ID")
+            
+            # Bound how many rows a hard kill can lose
+            if len(eobr_rows) >= EXCEL_FLUSH_ROWS:
+                try_flush_eobr_rows(folders, eobr_rows, state)
             
-            # Generate documents
             try:
-                docx_path, pdf_path = generate_document(adapted_record, eobr_data, folders)
+                if coordinated and not claim_order(order_id, worker_id):
+                    print(f"Skipping file {filename}: Order {order_id} is claimed by another worker.")
+                    skipped_count += 1
+                    claimed_paths.append(json_file_path)
+                    continue
+                
+                try:
+                    updated_items = process_record(
+                        record, adapted_record, filename, folders, state['historical_duplicates'],
+                        allocate_serial, eobr_rows
+                    )
+                finally:
+                    if coordinated:
+                        release_claim(order_id, worker_id)
+                
+                if updated_items is None:
+                    skipped_count += 1
+                    continue
+                
                 processed_count += 1
-                print(f"Generated EOBR {eobr_data['EOBR Number']}")
                 
-                # Update database with payment information and track updates
-                updated_items = update_database_with_payment(record, eobr_data)
-                if updated_items:
-                    db_updates.extend(updated_items)
+                # Log database updates as they happen so a crash keeps the audit trail
+                append_db_updates(folders['db_updates_log'], updated_items)
                 
                 # Track processed order ID
                 processed_order_ids.add(order_id)
-                
+                    
             except Exception as e:
-                print(f"Error generating documents for {filename}: {e}")
+                print(f"Error processing file {filename}: {e}")
                 skipped_count += 1
-                
-        except Exception as e:
-            print(f"Error processing file {filename}: {e}")
-            skipped_count += 1
+                failed_paths.append(json_file_path)
+    finally:
+        try_flush_eobr_rows(folders, eobr_rows, state)
     
     print(f"Processing complete. Processed: {processed_count}, Skipped: {skipped_count}")
+    cache_stats = get_cache_stats()
+    print(f"Render cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    if time.time() - state['last_cache_eviction'] >= RENDER_CACHE_EVICT_INTERVAL_SECONDS:
+        evict_render_cache()
+        state['last_cache_eviction'] = time.time()
+    
+    if processed_count == 0 and not eobr_rows:
+        # Nothing was paid, so the run folder only holds an empty workbook
+        shutil.rmtree(folders['root'], ignore_errors=True)
+        return failed_paths, claimed_paths
     
     # Save database updates to Excel
-    if db_updates:
-        df = pd.DataFrame(db_updates)
-        df.to_excel(folders['db_updates_excel'], index=False)
+    if finalize_db_updates(folders['db_updates_log'], folders['db_updates_excel']):
         print(f"\nSaved database updates to: {folders['db_updates_excel']}")
     
     # Verify database updates
-    print("\nVerifying database updates:")
-    for order_id in processed_order_ids:
-        list_line_items(order_id)
+    if verify:
+        print("\nVerifying database updates:")
+        for order_id in processed_order_ids:
+            list_line_items(order_id)
+    
+    return failed_paths, claimed_paths
+
+def process_json_directory(json_dir_path, worker_index=0, worker_count=1, coordinated=False):
+    """Process all JSON files in a directory and generate EOBR reports"""
+    state = initialize_run_state(worker_index, worker_count, coordinated)
+    if state is None:
+        return
+    
+    # Get all JSON files in the directory
+    json_files = glob.glob(os.path.join(json_dir_path, "*.json"))
+    print(f"Found {len(json_files)} JSON files to process.")
+    
+    process_json_files(json_files, state)
+
+def schedule_retry(retries, processed, path, signature, poll_interval):
+    """
+    Back off before retrying a file that failed with an error
+    
+    After WATCH_MAX_RETRIES failures the file is given up on until it changes.
+    """
+    previous = retries.get(path)
+    attempts = previous[1] + 1 if previous and previous[0] == signature else 1
+    if attempts >= WATCH_MAX_RETRIES:
+        print(f"Giving up on {os.path.basename(path)} after {attempts} failed attempts; "
+              f"it will be retried when the file changes.")
+        retries.pop(path, None)
+        processed[path] = signature
+        return
+    delay = min(WATCH_RETRY_MAX_SECONDS, poll_interval * 2 ** attempts)
+    retries[path] = (signature, attempts, time.time() + delay)
+
+def watch_json_directory(json_dir_path, poll_interval=WATCH_POLL_INTERVAL_SECONDS,
+                         worker_index=0, worker_count=1, coordinated=False):
+    """
+    Keep running and process new or changed JSON files as they arrive
+    
+    The directory is polled for mtime/size snapshots. Files already present
+    at startup are processed in the first batch; after that a file is picked
+    up once it has stopped changing between two polls. Files that fail with
+    an error are retried with exponential backoff, and files whose order is
+    claimed by another worker are checked again later.
+    """
+    state = initialize_run_state(worker_index, worker_count, coordinated)
+    if state is None:
+        return
+    
+    print(f"Watching {json_dir_path} for new JSON files (every {poll_interval}s, Ctrl+C to stop)")
+    previous = snapshot_directory(json_dir_path)
+    processed = {}
+    retries = {}  # path -> (signature, failed attempts, next attempt time)
+    
+    try:
+        while True:
+            current = snapshot_directory(json_dir_path)
+            now = time.time()
+            ready = [
+                path for path in find_ready_files(previous, current, processed)
+                if path not in retries or retries[path][0] != current[path] or retries[path][2] <= now
+            ]
+            
+            if ready:
+                batch = ready[:WATCH_BATCH_SIZE]
+                print(f"\nFound {len(batch)} new or changed JSON files.")
+                try:
+                    failed_paths, claimed_paths = map(set, process_json_files(batch, state, verify=False))
+                except Exception as e:
+                    print(f"Error processing batch: {e}")
+                    failed_paths, claimed_paths = set(batch), set()
+                
+                for path in batch:
+                    if path in failed_paths:
+                        schedule_retry(retries, processed, path, current[path], poll_interval)
+                    elif path in claimed_paths:
+                        # Check back once the other worker is done or its lease has expired;
+                        # this does not count as a failed attempt
+                        attempts = retries[path][1] if path in retries else 0
+                        retries[path] = (current[path], attempts, now + WATCH_RETRY_MAX_SECONDS)
+                    else:
+                        processed[path] = current[path]
+                        retries.pop(path, None)
+            
+            # Forget files that were removed so they are picked up if re-added
+            for path in set(processed) - set(current):
+                del processed[path]
+            for path in set(retries) - set(current):
+                del retries[path]
+            
+            previous = current
+            # Drain a backlog without waiting between batches
+            if len(ready) <= WATCH_BATCH_SIZE:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
 
 def update_database_with_payment(record, eobr_data):
-    """Update database with payment information for each line item"""
+    """
+    Update database with payment information for each line item
+    
+    All lines are paid in one transaction that only touches unpaid lines, so
+    concurrent runs can never pay the same item twice.
+    
+    Returns:
+        list: Database updates, or None if the transaction was rolled back
+    """
     order_id = record.get("Order_ID")
     eobr_number = eobr_data.get("EOBR Number")
-    total_paid = eobr_data.get("Total").replace("$", "").replace(",", "")
     processed_date = datetime.now().strftime("%Y-%m-%d")
     
-    updated_items = []
+    lines_by_id = {}
     for line in record.get("service_lines", []):
-        payment_id = line.get("payment_id", {})
-        line_item_id = payment_id.get("line_item_id")
-        
-        if line_item_id and order_id:
-            success = update_payment_info(
-                line_item_id=line_item_id,
-                order_id=order_id,
-                br_paid=str(line.get("assigned_rate", 0)),
-                br_rate=float(line.get("assigned_rate", 0)),
-                eobr_doc_no=eobr_number,
-                hcfa_doc_no=eobr_number,
-                br_date_processed=processed_date
-            )
-            
-            if success:
-                updated_items.append({
-                    'Line_Item_ID': line_item_id,
-                    'Order_ID': order_id,
-                    'CPT': line.get('cpt_code'),
-                    'BR_Paid': line.get("assigned_rate", 0),
-                    'BR_Rate': line.get("assigned_rate", 0),
-                    'EOBR_Doc_No': eobr_number,
-                    'Date_Processed': processed_date
-                })
+        line_item_id = line.get("payment_id", {}).get("line_item_id")
+        if line_item_id:
+            lines_by_id[line_item_id] = line
+    
+    paid_ids = pay_line_items(
+        order_id,
+        [(line_item_id, str(line.get("assigned_rate", 0)), float(line.get("assigned_rate", 0)))
+         for line_item_id, line in lines_by_id.items()],
+        eobr_doc_no=eobr_number,
+        hcfa_doc_no=eobr_number,
+        br_date_processed=processed_date
+    )
+    if paid_ids is None:
+        return None
+    
+    updated_items = []
+    for line_item_id in paid_ids:
+        line = lines_by_id[line_item_id]
+        updated_items.append({
+            'Line_Item_ID': line_item_id,
+            'Order_ID': order_id,
+            'CPT': line.get('cpt_code'),
+            'BR_Paid': line.get("assigned_rate", 0),
+            'BR_Rate': line.get("assigned_rate", 0),
+            'EOBR_Doc_No': eobr_number,
+            'Date_Processed': processed_date
+        })
     
     return updated_items
 
 if __name__ == "__main__":
-    process_json_directory(JSON_DIR_PATH)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate EOBR reports from validated JSON files")
+    parser.add_argument("--json-dir", default=JSON_DIR_PATH, help="Directory of JSON files to process")
+    parser.add_argument("--worker-index", type=int, default=0, help="Zero-based index of this worker")
+    parser.add_argument("--worker-count", type=int, default=1, help="Total number of workers sharing the directory")
+    parser.add_argument("--coordinated", action="store_true",
+                        help="Claim orders through the database even when running a single worker")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and process new or changed JSON files as they arrive")
+    parser.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL_SECONDS,
+                        help="Seconds between directory polls in watch mode")
+    args = parser.parse_args()
+    
+    if not 0 <= args.worker_index < args.worker_count:
+        parser.error("--worker-index must be between 0 and --worker-count - 1")
+    
+    if args.watch:
+        watch_json_directory(args.json_dir, args.poll_interval, args.worker_index, args.worker_count, args.coordinated)
+    else:
+        process_json_directory(args.json_dir, args.worker_index, args.worker_count, args.coordinated)
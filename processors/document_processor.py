@@ -1,8 +1,32 @@
+import io
+import hashlib
 import os
 from pathlib import Path
 from docx import Document
 from datetime import datetime
 from config.settings import WORD_TEMPLATE, ACCEPTABLE_MODIFIERS, ACCEPTABLE_POS
+from processors.render_cache import render_cache_key, fetch_rendered, store_rendered
+
+_template_cache = {}
+
+def _cached_template(template_path):
+    """Return (mtime, bytes, sha256) for the template, re-reading it only when it changes"""
+    mtime = os.path.getmtime(template_path)
+    cached = _template_cache.get(template_path)
+    if cached is None or cached[0] != mtime:
+        with open(template_path, "rb") as f:
+            content = f.read()
+        cached = (mtime, content, hashlib.sha256(content).hexdigest())
+        _template_cache[template_path] = cached
+    return cached
+
+def load_template(template_path=WORD_TEMPLATE):
+    """Return a fresh Document built from a cached copy of the template file"""
+    return Document(io.BytesIO(_cached_template(template_path)[1]))
+
+def template_hash(template_path=WORD_TEMPLATE):
+    """Return the SHA-256 of the template file"""
+    return _cached_template(template_path)[2]
 
 def process_line_items(line_items):
     """Process line items for document placeholders"""
@@ -89,13 +113,20 @@ def generate_document(record, eobr_data, output_folders):
     # Add line item details
     mapping.update(process_line_items(data.get("line_items", [])))
     
+    eobr_file_name = f"EOBR_{eobr_data['EOBR Number']}"
+    docx_output = os.path.join(output_folders['docs'], f"{eobr_file_name}.docx")
+    
+    # Reuse an identical document rendered earlier from the same template.
+    # <process_date> is part of the key, so only same-day reruns can hit.
+    cache_key = render_cache_key(mapping, template_hash())
+    if fetch_rendered(cache_key, docx_output):
+        return docx_output, None
+    
     # Create document
-    doc = Document(WORD_TEMPLATE)
+    doc = load_template()
     populate_placeholders(doc, mapping)
     
     # Save document
-    eobr_file_name = f"EOBR_{eobr_data['EOBR Number']}"
-    docx_output = os.path.join(output_folders['docs'], f"{eobr_file_name}.docx")
-    
     doc.save(docx_output)
+    store_rendered(cache_key, docx_output)
     return docx_output, None  # Return None for pdf_path since we're not generating PDFs
\ No newline at end of file
@@ -5,9 +5,13 @@ from dateutil.parser import parse
 
 from utils.formatters import format_date_for_eob, calculate_due_date
 
-def collect_additional_eobr_data(record, mapping, historical_duplicates, processed_control_numbers):
+def collect_additional_eobr_data(record, mapping, historical_duplicates, next_serial):
     """
     Collect additional data for EOBR record
+    
+    historical_duplicates holds every duplicate key seen so far; the caller
+    adds this record's key once its payment has committed.
+    next_serial(control_number) returns the serial to use for the EOBR number.
     Returns a dictionary with all fields needed for Excel
     """
     # Extract base file name
@@ -33,11 +37,8 @@ def collect_additional_eobr_data(record, mapping, historical_duplicates, process
         print(f"Error details: {str(e)}")
         raise ValueError(f"Failed to process date '{date_of_service}': {str(e)}")
     
-    # Get control number and generate EOBR number
+    # Get control number
     control_number = record.get("data", {}).get("patient_info", {}).get("FileMaker_Record_Number", "N/A")
-    eobr_serial = processed_control_numbers.get(control_number, 0) + 1
-    eobr_number = f"{control_number}-{eobr_serial}"
-    processed_control_numbers[control_number] = eobr_serial
     
     provider_info = record.get('data', {}).get('provider_info', {})
     billing_address = provider_info.get('Billing_Address', {})
@@ -48,13 +49,19 @@ def collect_additional_eobr_data(record, mapping, historical_duplicates, process
     # Get CPT codes and check for duplicates
     cpt_list = [line.get('cpt') for line in record.get('data', {}).get('line_items', []) if line.get('cpt')]
     duplicate_key = f"{control_number}|{','.join(cpt_list)}"
-    is_duplicate = duplicate_key in historical_duplicates or duplicate_key in processed_control_numbers
+    is_duplicate = duplicate_key in historical_duplicates
     release_payment = "N" if is_duplicate else "Y"
-    processed_control_numbers[duplicate_key] = True
     
     # Create description field with DOS, CPT codes, patient name, and control number
     description = f"{date_of_service} {','.join(cpt_list)} {record.get('data', {}).get('patient_info', {}).get('PatientName', 'N/A')} {control_number}"
     
+    line_items = record.get('data', {}).get('line_items', [])
+    amount = "${:,.2f}".format(sum(float(line.get('charge', 0)) for line in line_items))
+    total = "${:,.2f}".format(sum(float(line.get('validated_rate', 0)) for line in line_items))
+    
+    # Generate EOBR number last so bad input never uses up a serial
+    eobr_number = f"{control_number}-{next_serial(control_number)}"
+    
     # Return data dictionary
     return {
         "EOBR Number": eobr_number, 
@@ -65,8 +72,8 @@ def collect_additional_eobr_data(record, mapping, historical_duplicates, process
         "Mailing Address": mailing_address, 
         "Description": description,
         "Memo": f"{date_of_service}, {record.get('data', {}).get('patient_info', {}).get('PatientName', 'N/A')}",
-        "Amount": "${:,.2f}".format(sum(float(line.get('charge', 0)) for line in record.get('data', {}).get('line_items', []))),
-        "Total": "${:,.2f}".format(sum(float(line.get('validated_rate', 0)) for line in record.get('data', {}).get('line_items', []))),
+        "Amount": amount,
+        "Total": total,
         "Duplicate Check": "Duplicate" if is_duplicate else "Null", 
         "Full Duplicate Key": duplicate_key, 
         "Release Payment": release_payment,
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+from config.settings import RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_AGE_DAYS
+
+_stats = {"hits": 0, "misses": 0}
+
+def render_cache_key(mapping, template_digest):
+    """Build a cache key from the final placeholder mapping and the template hash"""
+    sanitized_mapping = {k: str(v) if v is not None else "" for k, v in mapping.items()}
+    payload = json.dumps(sanitized_mapping, sort_keys=True) + template_digest
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cache_path(key, extension):
+    return os.path.join(RENDER_CACHE_DIR, key[:2], f"{key}{extension}")
+
+def fetch_rendered(key, docx_output, pdf_output=None):
+    """
+    Place a previously rendered document at docx_output if one is cached
+
+    The cached PDF is placed at pdf_output as well when both are requested.
+
+    Returns:
+        bool: True on a cache hit, False if the document must be rendered
+    """
+    cached_docx = _cache_path(key, ".docx")
+    cached_pdf = _cache_path(key, ".pdf")
+    if not os.path.exists(cached_docx) or (pdf_output and not os.path.exists(cached_pdf)):
+        _stats["misses"] += 1
+        return False
+
+    try:
+        shutil.copyfile(cached_docx, docx_output)
+        if pdf_output:
+            shutil.copyfile(cached_pdf, pdf_output)
+    except OSError as e:
+        print(f"Warning: Could not reuse cached render {key}: {e}")
+        _stats["misses"] += 1
+        return False
+
+    # Refresh age so frequently reused entries survive eviction; another
+    # worker may have evicted the entry since the copy, which is harmless
+    now = time.time()
+    try:
+        os.utime(cached_docx, (now, now))
+        if pdf_output:
+            os.utime(cached_pdf, (now, now))
+    except OSError:
+        pass
+    _stats["hits"] += 1
+    return True
+
+def store_rendered(key, docx_path, pdf_path=None):
+    """Add a freshly rendered document (and PDF, if produced) to the cache"""
+    try:
+        for source, extension in ((docx_path, ".docx"), (pdf_path, ".pdf")):
+            if not source:
+                continue
+            destination = _cache_path(key, extension)
+            Path(destination).parent.mkdir(parents=True, exist_ok=True)
+            temp_path = f"{destination}.{os.getpid()}.tmp"
+            shutil.copyfile(source, temp_path)
+            os.replace(temp_path, destination)
+    except OSError as e:
+        print(f"Warning: Could not cache rendered document {key}: {e}")
+
+def evict_render_cache(max_bytes=RENDER_CACHE_MAX_BYTES, max_age_days=RENDER_CACHE_MAX_AGE_DAYS):
+    """
+    Remove cache entries older than max_age_days, then the least recently
+    used entries until the cache fits in max_bytes
+
+    An entry is the .docx and .pdf rendered for one key; both are removed
+    together. Partially written .tmp files are ignored.
+
+    Returns:
+        int: Number of entries removed
+    """
+    if not Path(RENDER_CACHE_DIR).exists():
+        return 0
+
+    entries = {}
+    for path in Path(RENDER_CACHE_DIR).glob("*/*"):
+        if path.suffix not in (".docx", ".pdf"):
+            continue
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        mtime, size, paths = entries.get(path.stem, (0, 0, []))
+        entries[path.stem] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [path])
+
+    cutoff = time.time() - max_age_days * 86400
+    total_bytes = sum(size for _, size, _ in entries.values())
+    removed = 0
+    for mtime, size, paths in sorted(entries.values(), key=lambda entry: entry[0]):  # Oldest first
+        if mtime >= cutoff and total_bytes <= max_bytes:
+            break
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        total_bytes -= size
+        removed += 1
+    return removed
+
+def get_cache_stats():
+    """Return hit/miss counters since the last reset"""
+    return dict(_stats)
+
+def reset_cache_stats():
+    """Reset hit/miss counters"""
+    _stats["hits"] = 0
+    _stats["misses"] = 0
@@ -0,0 +1,33 @@
+import os
+import glob
+
+def snapshot_directory(dir_path, pattern="*.json"):
+    """Return {path: (mtime_ns, size)} for the files matching pattern in dir_path"""
+    snapshot = {}
+    for path in glob.glob(os.path.join(dir_path, pattern)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed between listing and stat
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def find_ready_files(previous, current, processed):
+    """
+    Find new or changed files that are ready to process
+    
+    A file is ready once its mtime/size is unchanged between two polls (so it
+    is no longer being written) and differs from when it was last processed.
+    
+    Args:
+        previous (dict): Snapshot from the previous poll
+        current (dict): Snapshot from this poll
+        processed (dict): Snapshot values at the time each file was processed
+        
+    Returns:
+        list: Paths of ready files, sorted
+    """
+    return sorted(
+        path for path, signature in current.items()
+        if previous.get(path) == signature and processed.get(path) != signature
+    )
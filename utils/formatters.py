@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 from dateutil.parser import parse
 import holidays
 
@@ -26,9 +27,14 @@ def format_currency(amount):
     """Format amount as currency"""
     return "${:,.2f}".format(float(amount))
 
+@lru_cache(maxsize=None)
+def us_holidays_for(first_year):
+    """US holiday calendar covering first_year and the following year"""
+    return holidays.US(years=[first_year, first_year + 1])
+
 def calculate_due_date(bill_date):
     """Calculate due date based on bill date (45 business days)"""
-    us_holidays = holidays.US(years=[2021, 2022, 2023, 2024, 2025])
+    us_holidays = us_holidays_for(bill_date.year)
     due_date = bill_date
     days_added = 0
     while days_added < 45: